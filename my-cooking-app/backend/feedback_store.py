@@ -0,0 +1,253 @@
+"""
+On-disk feedback summary shared by every uvicorn worker.
+Workers merge their own preference deltas into it rather than overwriting it.
+Writes are atomic (temp file + os.replace) and serialized across processes
+with an OS lock (flock / msvcrt.locking) on a lockfile, which the OS releases
+if its holder dies. Without either, an O_EXCL lockfile with stale-owner
+stealing is used instead.
+"""
+import orjson
+
+import logging
+import os
+import tempfile
+import time
+import uuid
+from collections import Counter
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+logger = logging.getLogger("recipe_app")
+
+FEEDBACK_FILE = "feedback_summary.json"
+FEEDBACK_LOCK_FILE = FEEDBACK_FILE + ".lock"
+LOCK_RETRY_DELAY = 0.025
+LOCK_TIMEOUT = 5
+LOCK_STALE_AFTER = 30  # seconds before a fallback lockfile is considered abandoned
+OS_LOCK = fcntl is not None or msvcrt is not None
+
+# Read once at import: os.umask() can only be queried by setting it, which
+# isn't safe once merges run in worker threads
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+class LockLost(Exception):
+    """
+    The fallback lockfile was stolen while we held it; another writer may be active.
+    """
+
+
+def load_feedback_summary():
+    if not os.path.exists(FEEDBACK_FILE):
+        return {"preferences": {}}
+    try:
+        with open(FEEDBACK_FILE, "rb") as f:
+            return orjson.loads(f.read())
+    except Exception as e:
+        logger.error("Failed to load feedback summary: %s", e)
+        return {"preferences": {}}
+
+
+# === OS lock ===
+def try_os_lock(f):
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def acquire_os_lock():
+    # The lockfile itself is never removed, only locked and unlocked
+    f = open(FEEDBACK_LOCK_FILE, "a+b")
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while not try_os_lock(f):
+        if time.monotonic() > deadline:
+            f.close()
+            raise TimeoutError(f"Timed out waiting for {FEEDBACK_LOCK_FILE}")
+        time.sleep(LOCK_RETRY_DELAY)
+    return f
+
+
+def release_os_lock(f):
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    finally:
+        f.close()
+
+
+# === Fallback lockfile ===
+def read_lock(path):
+    """
+    Returns (token, mtime) of a lockfile, or None if it is gone or unreadable.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read().strip(), mtime
+    except OSError:
+        return None
+
+
+def owner_is_alive(token):
+    if os.name == "nt":
+        # os.kill(pid, 0) sends CTRL_C_EVENT on Windows; rely on the mtime check there
+        return True
+    try:
+        os.kill(int(token.split()[0]), 0)
+    except ProcessLookupError:
+        return False
+    except (OSError, ValueError, IndexError):
+        # Owned by another user or unparsable: only the mtime check can steal it
+        return True
+    return True
+
+
+def lock_is_stale(lock):
+    token, mtime = lock
+    return time.time() - mtime > LOCK_STALE_AFTER or not owner_is_alive(token)
+
+
+def steal_stale_lock(stale_token):
+    """
+    Removes a lock judged stale. The rename is atomic, so only one waiter wins it.
+    If what we moved turns out to be a fresh lock created after the check, it is
+    not put back: its holder notices the loss (lock_still_held) and fails its
+    merge, and we compete for the lock with O_EXCL like everyone else.
+    """
+    grave = f"{FEEDBACK_LOCK_FILE}.{uuid.uuid4().hex}.stale"
+    try:
+        os.rename(FEEDBACK_LOCK_FILE, grave)
+    except FileNotFoundError:
+        return  # released or already stolen by another waiter
+    moved = read_lock(grave)
+    if moved is not None and moved[0] != stale_token:
+        logger.warning("Removed a live feedback summary lock while stealing a stale one")
+    else:
+        logger.warning("Stole stale feedback summary lock")
+    try:
+        os.remove(grave)
+    except FileNotFoundError:
+        pass
+
+
+def acquire_lockfile():
+    token = f"{os.getpid()} {uuid.uuid4().hex}"
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while True:
+        try:
+            fd = os.open(FEEDBACK_LOCK_FILE, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            lock = read_lock(FEEDBACK_LOCK_FILE)
+            if lock is not None and lock_is_stale(lock):
+                steal_stale_lock(lock[0])
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out waiting for {FEEDBACK_LOCK_FILE}")
+            time.sleep(LOCK_RETRY_DELAY)
+            continue
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(token)
+        return token
+
+
+def release_lockfile(token):
+    # Only remove the lock if it is still ours (it may have been stolen as stale)
+    if not lock_still_held(token):
+        return
+    try:
+        os.remove(FEEDBACK_LOCK_FILE)
+    except FileNotFoundError:
+        pass
+
+
+# === Summary lock ===
+def acquire_summary_lock():
+    """
+    Takes the summary lock and returns the handle to release it with.
+    """
+    if OS_LOCK:
+        return acquire_os_lock()
+    return acquire_lockfile()
+
+
+def release_summary_lock(handle):
+    if isinstance(handle, str):
+        release_lockfile(handle)
+    else:
+        release_os_lock(handle)
+
+
+def lock_still_held(handle):
+    # OS locks can't be taken away; a fallback lockfile can be stolen
+    if not isinstance(handle, str):
+        return True
+    lock = read_lock(FEEDBACK_LOCK_FILE)
+    return lock is not None and lock[0] == handle
+
+
+# === Writing ===
+def write_summary_file(data):
+    """
+    Writes to a temp file of our own, then atomically swaps it into place.
+    """
+    directory = os.path.dirname(os.path.abspath(FEEDBACK_FILE))
+    with tempfile.NamedTemporaryFile(
+        dir=directory, prefix=os.path.basename(FEEDBACK_FILE) + ".", suffix=".tmp", delete=False
+    ) as f:
+        tmp_file = f.name
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    try:
+        # mkstemp creates 0600 files; keep the mode a plain open() would give
+        try:
+            mode = os.stat(FEEDBACK_FILE).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o666 & ~UMASK
+        os.chmod(tmp_file, mode)
+        os.replace(tmp_file, FEEDBACK_FILE)
+    except OSError:
+        os.remove(tmp_file)
+        raise
+
+
+def merge_feedback_deltas(deltas):
+    """
+    Adds a worker's preference deltas to the summary on disk, re-reading it
+    under the lock so other workers' counts are kept.
+    The replace is atomic, so readers never see a torn write.
+    Returns the merged preferences, or None if the merge failed.
+    """
+    try:
+        handle = acquire_summary_lock()
+        try:
+            summary = load_feedback_summary()
+            prefs = Counter(summary.get("preferences", {}))
+            prefs.update(deltas)
+            summary["preferences"] = dict(prefs)
+            # Only matters for the fallback lockfile; narrows, but can't close,
+            # the window in which a stolen lock lets a second writer in
+            if not lock_still_held(handle):
+                raise LockLost(f"{FEEDBACK_LOCK_FILE} was taken over during the merge")
+            write_summary_file(summary)
+            return prefs
+        finally:
+            release_summary_lock(handle)
+    except Exception as e:
+        logger.error("Failed to merge feedback summary: %s", e)
+        return None
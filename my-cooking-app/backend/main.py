@@ -1,74 +1,135 @@
-from dotenv import load_dotenv
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-from google import genai
-from pydantic import BaseModel
-
-import json
-import logging
-import os
-import time
-
-load_dotenv()
-
-google_client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+from fastapi.responses import StreamingResponse
 
-# === Logging setup ===
-logger = logging.getLogger("recipe_app")
-logger.setLevel(logging.INFO)
-logger.propagate = False
-if logger.hasHandlers():
-    logger.handlers.clear()
+import aiofiles
+import orjson
 
-file_handler = logging.FileHandler("recipe_server.log", mode="a", encoding="utf-8")
-file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-logger.addHandler(file_handler)
-
-# === FastAPI setup ===
-app = FastAPI()
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+import asyncio
+import re
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+
+from feedback_store import load_feedback_summary, merge_feedback_deltas
+from recipe_core import (
+    GEMINI_MODEL,
+    ChatRequest,
+    FeedbackRequest,
+    build_adaptive_prompt,
+    build_prompt,
+    create_app,
+    generate_reply,
+    google_client,
+    logger,
+    message_too_long_response,
+    parse_recipe_reply,
 )
 
-# === Models ===
-class ChatMessage(BaseModel):
-    role: str
-    text: str
-
-class ChatRequest(BaseModel):
-    message: str
-    history: list[ChatMessage] | None = None
+# === Keyword matching ===
+COMPLAINT_PREFS = {
+    "too easy": "make_harder",
+    "simple": "make_harder",
+    "too hard": "make_easier",
+    "complex": "make_easier",
+    "more ingredient": "add_ingredients",
+    "add": "add_ingredients",
+    "less ingredient": "reduce_ingredients",
+    "simplify": "reduce_ingredients",
+    "faster": "shorter_time",
+    "quick": "shorter_time",
+    "longer": "longer_time",
+    "slow cook": "longer_time",
+}
+COMPLAINT_RE = re.compile("|".join(re.escape(k) for k in sorted(COMPLAINT_PREFS, key=len, reverse=True)))
+
+
+# === In-memory feedback summary ===
+# Every worker counts its own feedback in PENDING and merges it into the summary
+# file (under its lockfile) at most every FLUSH_DELAY seconds. Chat reads the
+# merged file again at most every SUMMARY_TTL seconds, so feedback sent to any
+# worker reaches every worker's prompts shortly after.
+# feedback_log.jsonl stays the durable append-only record.
+FLUSH_DELAY = 0.5  # seconds to coalesce feedback before merging it
+SUMMARY_TTL = 2  # seconds before chat re-reads the merged summary
+
+disk_prefs = Counter(load_feedback_summary().get("preferences", {}))
+disk_loaded_at = time.monotonic()
+PENDING = Counter()  # this worker's feedback not yet merged into the file
+summary_lock = asyncio.Lock()
+write_lock = asyncio.Lock()  # at most one summary writer per process
+flush_task = None
+
+# === Adaptive prompt ===
+# Only changes when preferences do, so it is cached and rebuilt lazily.
+ADAPTIVE_PROMPT = None
+
+
+async def flush_pending_feedback():
+    """
+    Merges this worker's pending deltas into the summary file.
+    On failure they stay pending and go out with the next flush.
+    """
+    global PENDING, disk_prefs, disk_loaded_at, ADAPTIVE_PROMPT
+    async with write_lock:
+        deltas = +PENDING
+        if not deltas:
+            return
+        merged = await asyncio.to_thread(merge_feedback_deltas, deltas)
+        if merged is None:
+            return
+        async with summary_lock:
+            PENDING.subtract(deltas)
+            PENDING = +PENDING
+            disk_prefs = merged
+            disk_loaded_at = time.monotonic()
+            ADAPTIVE_PROMPT = None
+
+
+async def flush_feedback_summary():
+    """
+    Waits FLUSH_DELAY so bursts of feedback collapse into a single merge.
+    """
+    global flush_task
+    await asyncio.sleep(FLUSH_DELAY)
+    flush_task = None
+    await flush_pending_feedback()
 
-class FeedbackRequest(BaseModel):
-    type: str  # upvote / downvote
-    message: str | None = None
 
+def schedule_summary_flush():
+    global flush_task
+    if flush_task is None:
+        flush_task = asyncio.create_task(flush_feedback_summary())
 
-# === Utility: Load & Save Feedback Summary ===
-FEEDBACK_FILE = "feedback_summary.json"
 
-def load_feedback_summary():
-    if not os.path.exists(FEEDBACK_FILE):
-        return {"preferences": {}}
-    try:
-        with open(FEEDBACK_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception as e:
-        logger.error(f"Failed to load feedback summary: {e}")
-        return {"preferences": {}}
+async def refresh_preferences():
+    """
+    Re-reads the merged summary once it is older than SUMMARY_TTL.
+    Skipped while a flush is running, since the flush refreshes disk_prefs itself
+    and a read racing it would either miss or double-count the flushed deltas.
+    """
+    global disk_prefs, disk_loaded_at, ADAPTIVE_PROMPT
+    if time.monotonic() - disk_loaded_at < SUMMARY_TTL or write_lock.locked():
+        return
+    started = disk_loaded_at = time.monotonic()  # one reload at a time, not one per request
+    prefs = Counter((await asyncio.to_thread(load_feedback_summary)).get("preferences", {}))
+    # A flush that started (or finished) during the read makes the result stale
+    if disk_loaded_at != started or write_lock.locked():
+        return
+    if prefs != disk_prefs:
+        disk_prefs = prefs
+        ADAPTIVE_PROMPT = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    # Don't lose feedback still waiting in the debounce window
+    if flush_task is not None:
+        await flush_task
+    await flush_pending_feedback()
 
 
-def save_feedback_summary(data):
-    try:
-        with open(FEEDBACK_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-    except Exception as e:
-        logger.error(f"Failed to save feedback summary: {e}")
+# === FastAPI setup ===
+app = create_app(lifespan=lifespan)
 
 
 # === FEEDBACK ENDPOINT ===
@@ -76,8 +137,9 @@ def save_feedback_summary(data):
 async def feedback(req: FeedbackRequest):
     """
     Collects user feedback from frontend.
-    Updates feedback summary file and logs raw feedback.
+    Counts it towards this worker's pending preferences and logs raw feedback.
     """
+    global ADAPTIVE_PROMPT
     feedback_entry = {
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
         "type": req.type,
@@ -85,151 +147,110 @@ async def feedback(req: FeedbackRequest):
     }
 
     # Log feedback
-    logger.info(f"User feedback: {feedback_entry}")
+    logger.info("User feedback: %s", feedback_entry)
 
     # Append raw feedback to a .jsonl file
-    with open("feedback_log.jsonl", "a", encoding="utf-8") as f:
-        f.write(json.dumps(feedback_entry, ensure_ascii=False) + "\n")
-
-    # === Update preference summary ===
-    summary = load_feedback_summary()
-    prefs = summary.get("preferences", {})
+    async with aiofiles.open("feedback_log.jsonl", "ab") as f:
+        await f.write(orjson.dumps(feedback_entry) + b"\n")
 
     # Normalize message to lower case for matching
     msg = (req.message or "").lower()
 
-    if req.type == "upvote":
-        prefs["positive_feedback_count"] = prefs.get("positive_feedback_count", 0) + 1
-    else:
-        prefs["negative_feedback_count"] = prefs.get("negative_feedback_count", 0) + 1
-        # Track specific complaint types
-        if "too easy" in msg or "simple" in msg:
-            prefs["make_harder"] = prefs.get("make_harder", 0) + 1
-        if "too hard" in msg or "complex" in msg:
-            prefs["make_easier"] = prefs.get("make_easier", 0) + 1
-        if "more ingredient" in msg or "add" in msg:
-            prefs["add_ingredients"] = prefs.get("add_ingredients", 0) + 1
-        if "less ingredient" in msg or "simplify" in msg:
-            prefs["reduce_ingredients"] = prefs.get("reduce_ingredients", 0) + 1
-        if "faster" in msg or "quick" in msg:
-            prefs["shorter_time"] = prefs.get("shorter_time", 0) + 1
-        if "longer" in msg or "slow cook" in msg:
-            prefs["longer_time"] = prefs.get("longer_time", 0) + 1
-
-    summary["preferences"] = prefs
-    save_feedback_summary(summary)
+    # === Update preference summary ===
+    async with summary_lock:
+        if req.type == "upvote":
+            PENDING["positive_feedback_count"] += 1
+        else:
+            PENDING["negative_feedback_count"] += 1
+            # Track specific complaint types (each counted once per message)
+            PENDING.update({COMPLAINT_PREFS[m.group()] for m in COMPLAINT_RE.finditer(msg)})
+
+        ADAPTIVE_PROMPT = None
+        schedule_summary_flush()
 
     return {"status": "success", "message": "Feedback received"}
 
 
+# === Prompt building ===
+async def build_chat_prompt(user_input, history):
+    """
+    Builds the full Gemini prompt for a chat turn using the cached adaptive prompt.
+    Returns (full_prompt, wants_recipe).
+    """
+    global ADAPTIVE_PROMPT
+    await refresh_preferences()
+    if ADAPTIVE_PROMPT is None:
+        # Merged counts from every worker plus our own not yet flushed
+        ADAPTIVE_PROMPT = build_adaptive_prompt(disk_prefs + PENDING)
+    return build_prompt(user_input, history, ADAPTIVE_PROMPT)
+
+
 # === CHAT ENDPOINT ===
 @app.post("/api/chat")
 async def chat(req: ChatRequest):
     """
     Handles chat requests with adaptive prompt tuning based on past feedback.
     """
-    user_input = req.message
-    history = req.history or []
-
-    # === Load adaptive preferences ===
-    summary = load_feedback_summary()
-    prefs = summary.get("preferences", {})
-
-    # === Build dynamic tuning instructions ===
-    tuning_notes = []
-    if prefs.get("make_harder", 0) > prefs.get("make_easier", 0):
-        tuning_notes.append("Make recipes slightly more complex and advanced.")
-    elif prefs.get("make_easier", 0) > prefs.get("make_harder", 0):
-        tuning_notes.append("Simplify recipes with fewer cooking techniques.")
-
-    if prefs.get("add_ingredients", 0) > prefs.get("reduce_ingredients", 0):
-        tuning_notes.append("Include more diverse ingredients.")
-    elif prefs.get("reduce_ingredients", 0) > prefs.get("add_ingredients", 0):
-        tuning_notes.append("Use fewer ingredients for simpler dishes.")
-
-    if prefs.get("shorter_time", 0) > prefs.get("longer_time", 0):
-        tuning_notes.append("Prioritize faster, quick-cook recipes.")
-    elif prefs.get("longer_time", 0) > prefs.get("shorter_time", 0):
-        tuning_notes.append("Add more slow-cook or longer recipes for flavor depth.")
-
-    adaptive_prompt = (
-        "Based on user feedback, adjust your style accordingly:\n"
-        + ("\n".join(f"- {note}" for note in tuning_notes) if tuning_notes else "- Maintain your current balance.")
-    )
-
-    # === System prompt ===
-    system_prompt = (
-        "You are a helpful and creative recipe builder who can also chat casually.\n"
-        "If the user asks about recipes or ingredients, respond with a valid JSON recipe using the schema below.\n"
-        "Otherwise, respond conversationally in plain text.\n\n"
-        f"{adaptive_prompt}\n"
-    )
-
-    # === Detect if user wants a recipe ===
-    recipe_triggers = ["recipe", "cook", "ingredients", "dish", "meal", "food", "bake", "grill"]
-    wants_recipe = any(word in user_input.lower() for word in recipe_triggers)
-
-    # === Build conversation history ===
-    conversation = "\n".join([f"{m.role.capitalize()}: {m.text}" for m in history])
-    if conversation:
-        conversation += "\n"
-    conversation += f"User: {user_input}"
-
-    # === Recipe schema ===
-    if wants_recipe:
-        instruction = (
-            "\nNow generate a recipe in valid JSON format using this schema:\n"
-            "{\n"
-            '  "recipes": [\n'
-            "    {\n"
-            '      "name": "Recipe Name",\n'
-            '      "ingredients": ["list", "of", "ingredients"],\n'
-            '      "instructions": ["step", "by", "step", "instructions"],\n'
-            '      "cookingTime": "estimated time",\n'
-            '      "difficulty": "Easy | Medium | Hard",\n'
-            '      "nutrition": {\n'
-            '        "calories": 450,\n'
-            '        "protein": "12g",\n'
-            '        "carbs": "60g"\n'
-            "      },\n"
-            '      "otherInfo": {"optional": "any extra notes"}\n'
-            "    }\n"
-            "  ]\n"
-            "}"
-        )
-    else:
-        instruction = "\nRespond conversationally in natural language, not JSON."
-
-    full_prompt = f"System: {system_prompt}\n\n{conversation}\n{instruction}"
-    logger.info(f"Full Prompt (truncated): {full_prompt[:300]}...")
-
-    # === Call Gemini with retries ===
-    for attempt in range(3):
-        try:
-            response = google_client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=full_prompt,
-            )
-            reply_text = response.text or "(No response from model)"
+    too_long = message_too_long_response(req.message)
+    if too_long is not None:
+        return too_long
+    full_prompt, wants_recipe = await build_chat_prompt(req.message, req.history or [])
 
-            parsed_output = None
-            if wants_recipe:
-                try:
-                    parsed_output = json.loads(reply_text)
-                except Exception:
-                    logger.warning("Invalid JSON output from Gemini")
-                    parsed_output = None
+    # === Call Gemini (identical in-flight prompts share one call) ===
+    reply_text = await generate_reply(full_prompt)
+    if reply_text is None:
+        return {
+            "reply": "Error: Failed to get a response from Gemini after multiple attempts.",
+            "is_json": False,
+        }
 
-            return {
-                "reply": parsed_output if parsed_output else reply_text,
-                "is_json": bool(parsed_output),
-            }
-
-        except Exception as e:
-            logger.error(f"Attempt {attempt+1} failed: {e}")
-            time.sleep(2 ** attempt)
+    parsed_output = parse_recipe_reply(reply_text) if wants_recipe else None
 
     return {
-        "reply": "Error: Failed to get a response from Gemini after multiple attempts.",
-        "is_json": False,
+        "reply": parsed_output if parsed_output else reply_text,
+        "is_json": bool(parsed_output),
     }
+
+
+# === STREAMING CHAT ENDPOINT ===
+def sse_event(event, data):
+    # Data is JSON-encoded so newlines in model text can't break the framing
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+
+@app.post("/api/chat/stream")
+async def chat_stream(req: ChatRequest):
+    """
+    Same prompt as /api/chat, but relays Gemini's reply as server-sent events:
+    - "chunk": a piece of reply text, as it arrives
+    - "error": the upstream call failed; any chunks sent so far are incomplete
+    - "done": the reply is complete; for recipe requests carries the parsed JSON
+      (or null) in the same {"reply", "is_json"} shape as /api/chat
+    Unlike /api/chat this calls Gemini directly: no retries, reply cache or
+    coalescing of identical requests.
+    """
+    too_long = message_too_long_response(req.message)
+    if too_long is not None:
+        return too_long
+    full_prompt, wants_recipe = await build_chat_prompt(req.message, req.history or [])
+
+    async def relay():
+        chunks = []  # joined once at the end, never concatenated per chunk
+        try:
+            stream = await google_client.aio.models.generate_content_stream(
+                model=GEMINI_MODEL,
+                contents=full_prompt,
+            )
+            async for part in stream:
+                if part.text:
+                    chunks.append(part.text)
+                    yield sse_event("chunk", part.text)
+        except Exception as e:
+            logger.error("Streaming from Gemini failed: %s", e)
+            yield sse_event("error", {"message": "Failed to get a complete response from Gemini."})
+            return
+
+        parsed_output = parse_recipe_reply("".join(chunks)) if wants_recipe else None
+        yield sse_event("done", {"reply": parsed_output, "is_json": bool(parsed_output)})
+
+    return StreamingResponse(relay(), media_type="text/event-stream")
@@ -0,0 +1,288 @@
+"""
+Shared pieces of the recipe backends (main.py and simple_main.py):
+Gemini client, logging, FastAPI app setup, request models, prompt building
+and the Gemini call with retries, caching and in-flight coalescing.
+"""
+from dotenv import load_dotenv
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from google import genai
+from google.genai import types
+from pydantic import BaseModel, ConfigDict
+
+import httpx
+import orjson
+from cachetools import TTLCache
+
+import asyncio
+import atexit
+import hashlib
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+
+load_dotenv()
+
+GEMINI_MODEL = "gemini-2.5-flash"
+
+# One client for the whole process, with an explicit keep-alive pool so
+# concurrent chat requests reuse TCP/TLS connections to Gemini.
+http_limits = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+google_client = genai.Client(
+    api_key=os.getenv("GOOGLE_API_KEY"),
+    http_options=types.HttpOptions(
+        client_args={"limits": http_limits},
+        async_client_args={"limits": http_limits},
+    ),
+)
+
+# === Logging setup ===
+logger = logging.getLogger("recipe_app")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+if logger.hasHandlers():
+    logger.handlers.clear()
+
+file_handler = logging.FileHandler("recipe_server.log", mode="a", encoding="utf-8")
+file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+
+# Requests only enqueue records; a background thread does the disk writes
+log_queue = queue.Queue(-1)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+
+# === FastAPI setup ===
+# Frontend origins allowed to call the API (Vite dev server by default).
+# Override with a comma-separated CORS_ORIGINS in .env.
+CORS_ORIGINS = os.getenv("CORS_ORIGINS", "http://localhost:5173,http://127.0.0.1:5173").split(",")
+
+
+def create_app(lifespan=None):
+    app = FastAPI(lifespan=lifespan)
+
+    # Concrete origins/methods/headers let browsers cache the preflight for a day
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=[origin.strip() for origin in CORS_ORIGINS if origin.strip()],
+        allow_credentials=True,
+        allow_methods=["POST"],
+        allow_headers=["content-type"],
+        max_age=86400,
+    )
+    return app
+
+
+# === Models ===
+# frozen=True makes requests read-only once validated. extra="ignore" is
+# pydantic's default, spelled out because the frontend sends extra keys
+# (formattedJson, isJson) with history items.
+REQUEST_CONFIG = ConfigDict(extra="ignore", frozen=True)
+
+class ChatMessage(BaseModel):
+    model_config = REQUEST_CONFIG
+    role: str
+    text: str
+
+class ChatRequest(BaseModel):
+    model_config = REQUEST_CONFIG
+    message: str
+    history: list[ChatMessage] | None = None
+
+class FeedbackRequest(BaseModel):
+    model_config = REQUEST_CONFIG
+    type: str  # upvote / downvote
+    message: str | None = None
+
+
+# === Keyword matching ===
+# Each message is lowered once and scanned in a single regex pass.
+RECIPE_TRIGGERS = frozenset({"recipe", "cook", "ingredients", "dish", "meal", "food", "bake", "grill"})
+RECIPE_TRIGGER_RE = re.compile("|".join(re.escape(w) for w in sorted(RECIPE_TRIGGERS)))
+
+# Markdown code fence Gemini often wraps JSON replies in
+FENCE_RE = re.compile(r"^```[a-zA-Z]*\s*|\s*```$")
+
+
+# === Prompt templates ===
+SYSTEM_PROMPT_HEADER = (
+    "You are a helpful and creative recipe builder who can also chat casually.\n"
+    "If the user asks about recipes or ingredients, respond with a valid JSON recipe using the schema below.\n"
+    "Otherwise, respond conversationally in plain text.\n\n"
+)
+
+RECIPE_INSTRUCTION = (
+    "\nNow generate a recipe in valid JSON format using this schema:\n"
+    "{\n"
+    '  "recipes": [\n'
+    "    {\n"
+    '      "name": "Recipe Name",\n'
+    '      "ingredients": ["list", "of", "ingredients"],\n'
+    '      "instructions": ["step", "by", "step", "instructions"],\n'
+    '      "cookingTime": "estimated time",\n'
+    '      "difficulty": "Easy | Medium | Hard",\n'
+    '      "nutrition": {\n'
+    '        "calories": 450,\n'
+    '        "protein": "12g",\n'
+    '        "carbs": "60g"\n'
+    "      },\n"
+    '      "otherInfo": {"optional": "any extra notes"}\n'
+    "    }\n"
+    "  ]\n"
+    "}"
+)
+
+CHAT_INSTRUCTION = "\nRespond conversationally in natural language, not JSON."
+
+
+# === Prompt building ===
+# Client-supplied history is bounded so prompt size (and Gemini input tokens)
+# can't grow without limit.
+MAX_HISTORY_TURNS = 20
+MAX_HISTORY_CHARS = 4000
+MAX_MESSAGE_CHARS = 8000
+
+
+def message_too_long_response(message):
+    """
+    Returns a 413 in the {"reply", "is_json"} shape the frontend reads,
+    or None if the message is short enough.
+    """
+    if len(message) <= MAX_MESSAGE_CHARS:
+        return None
+    return JSONResponse(
+        status_code=413,
+        content={
+            "reply": f"Error: Please keep messages under {MAX_MESSAGE_CHARS} characters.",
+            "is_json": False,
+        },
+    )
+
+
+def build_adaptive_prompt(prefs):
+    """
+    Turns accumulated feedback preferences into tuning instructions.
+    """
+    tuning_notes = []
+    if prefs.get("make_harder", 0) > prefs.get("make_easier", 0):
+        tuning_notes.append("Make recipes slightly more complex and advanced.")
+    elif prefs.get("make_easier", 0) > prefs.get("make_harder", 0):
+        tuning_notes.append("Simplify recipes with fewer cooking techniques.")
+
+    if prefs.get("add_ingredients", 0) > prefs.get("reduce_ingredients", 0):
+        tuning_notes.append("Include more diverse ingredients.")
+    elif prefs.get("reduce_ingredients", 0) > prefs.get("add_ingredients", 0):
+        tuning_notes.append("Use fewer ingredients for simpler dishes.")
+
+    if prefs.get("shorter_time", 0) > prefs.get("longer_time", 0):
+        tuning_notes.append("Prioritize faster, quick-cook recipes.")
+    elif prefs.get("longer_time", 0) > prefs.get("shorter_time", 0):
+        tuning_notes.append("Add more slow-cook or longer recipes for flavor depth.")
+
+    return (
+        "Based on user feedback, adjust your style accordingly:\n"
+        + ("\n".join(f"- {note}" for note in tuning_notes) if tuning_notes else "- Maintain your current balance.")
+    )
+
+
+def build_prompt(user_input, history, adaptive_prompt):
+    """
+    Builds the full Gemini prompt for a chat turn.
+    Returns (full_prompt, wants_recipe).
+    """
+    # === Detect if user wants a recipe ===
+    wants_recipe = RECIPE_TRIGGER_RE.search(user_input.lower()) is not None
+
+    # === Build conversation history (most recent turns only) ===
+    conversation = "\n".join([f"{m.role.capitalize()}: {m.text}" for m in history[-MAX_HISTORY_TURNS:]])
+    if len(conversation) > MAX_HISTORY_CHARS:
+        conversation = conversation[-MAX_HISTORY_CHARS:]
+    if conversation:
+        conversation += "\n"
+    conversation += f"User: {user_input}"
+
+    # === Recipe schema ===
+    instruction = RECIPE_INSTRUCTION if wants_recipe else CHAT_INSTRUCTION
+
+    full_prompt = f"System: {SYSTEM_PROMPT_HEADER}{adaptive_prompt}\n\n\n{conversation}\n{instruction}"
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Full Prompt (truncated): %s...", full_prompt[:300])
+    return full_prompt, wants_recipe
+
+
+# === Gemini calls ===
+# Prompt -> task for calls still in flight, so concurrent identical requests
+# (double submits, client retries) are answered by a single upstream call.
+# A real multi-prompt batch isn't possible here: a list of contents is read
+# by Gemini as one conversation, not as independent prompts.
+INFLIGHT = {}
+
+# Recent replies by prompt hash. The prompt embeds the adaptive tuning notes,
+# so feedback that changes them naturally misses the cache.
+REPLY_CACHE = TTLCache(maxsize=1024, ttl=3600)
+NO_REPLY_TEXT = "(No response from model)"
+
+
+async def call_gemini(full_prompt):
+    """
+    Calls Gemini with retries. Returns the reply text, or None if every attempt failed.
+    """
+    for attempt in range(3):
+        try:
+            response = await google_client.aio.models.generate_content(
+                model=GEMINI_MODEL,
+                contents=full_prompt,
+            )
+            return response.text or NO_REPLY_TEXT
+        except Exception as e:
+            logger.error("Attempt %d failed: %s", attempt + 1, e)
+            if attempt < 2:
+                # Back off without blocking other requests on the event loop
+                await asyncio.sleep(min(2 ** attempt, 8) + random.random() * 0.25)
+    return None
+
+
+def prompt_key(full_prompt):
+    return hashlib.blake2b(full_prompt.encode("utf-8"), digest_size=16).hexdigest()
+
+
+async def generate_reply(full_prompt):
+    key = prompt_key(full_prompt)
+    reply_text = REPLY_CACHE.get(key)
+    if reply_text is not None:
+        return reply_text
+
+    task = INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.create_task(call_gemini(full_prompt))
+        INFLIGHT[key] = task
+        task.add_done_callback(lambda _: INFLIGHT.pop(key, None))
+    # Shield so one client disconnecting doesn't cancel the call for the others
+    reply_text = await asyncio.shield(task)
+
+    # Failures and empty replies are worth retrying, so don't cache them
+    if reply_text is not None and reply_text != NO_REPLY_TEXT:
+        REPLY_CACHE[key] = reply_text
+    return reply_text
+
+
+def parse_recipe_reply(reply_text):
+    """
+    Parses a JSON recipe reply, skipping the parse when it can't possibly be JSON.
+    """
+    text = reply_text.strip()
+    if text.startswith("```"):
+        text = FENCE_RE.sub("", text).strip()
+    if text and text[0] in "{[" and text[-1] in "}]":
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    logger.warning("Invalid JSON output from Gemini")
+    return None
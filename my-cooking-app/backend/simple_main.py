@@ -1,30 +1,13 @@
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from dotenv import load_dotenv
 from anthropic import Anthropic
-from google import genai
 
 import os
 
-load_dotenv()
-anthropic_client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-google_client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+from recipe_core import ChatRequest, create_app, generate_reply, message_too_long_response
 
-app = FastAPI()
+anthropic_client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
 
 # Allow requests from your frontend (Vite uses port 5173)
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # or ["http://localhost:5173"]
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# Message format
-class ChatRequest(BaseModel):
-    message: str
+app = create_app()
 
 # @app.post("/api/chat")
 # def chat_endpoint(req: ChatRequest):
@@ -36,6 +19,9 @@ class ChatRequest(BaseModel):
 
 @app.post("/api/chat")
 async def chat(req: ChatRequest):
+    too_long = message_too_long_response(req.message)
+    if too_long is not None:
+        return too_long
     user_input = req.message
 
     # Claude model call
@@ -49,10 +35,8 @@ async def chat(req: ChatRequest):
     # )
     # reply_text = response.content[0].text
 
-    response = google_client.models.generate_content(
-        model="gemini-2.5-flash", contents=user_input
-    )
-    print(response.text)
-    reply_text = response.text
-    
-    return {"reply": reply_text}
\ No newline at end of file
+    reply_text = await generate_reply(user_input)
+    if reply_text is None:
+        reply_text = "Error: Failed to get a response from Gemini after multiple attempts."
+
+    return {"reply": reply_text}
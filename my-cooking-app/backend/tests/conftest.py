@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The backend modules are imported as top-level modules, as uvicorn does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# genai.Client refuses to build without a key; tests never reach Gemini
+os.environ.setdefault("GOOGLE_API_KEY", "test")
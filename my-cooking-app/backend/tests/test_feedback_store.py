@@ -0,0 +1,173 @@
+import orjson
+import pytest
+
+import os
+import subprocess
+import sys
+import time
+
+import feedback_store
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_dir(tmp_path, monkeypatch):
+    # Store paths are relative, so each test gets its own files
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def lockfile_fallback(monkeypatch):
+    monkeypatch.setattr(feedback_store, "OS_LOCK", False)
+
+
+def write_lock(token, age=0):
+    with open(feedback_store.FEEDBACK_LOCK_FILE, "w", encoding="utf-8") as f:
+        f.write(token)
+    if age:
+        past = time.time() - age
+        os.utime(feedback_store.FEEDBACK_LOCK_FILE, (past, past))
+
+
+def lock_token():
+    lock = feedback_store.read_lock(feedback_store.FEEDBACK_LOCK_FILE)
+    return lock and lock[0]
+
+
+def dead_pid():
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    return proc.pid
+
+
+def read_summary():
+    with open(feedback_store.FEEDBACK_FILE, "rb") as f:
+        return orjson.loads(f.read())
+
+
+def test_merge_keeps_other_workers_counts():
+    feedback_store.merge_feedback_deltas({"make_harder": 2, "positive_feedback_count": 1})
+
+    merged = feedback_store.merge_feedback_deltas({"make_harder": 1, "shorter_time": 1})
+
+    assert merged == {"make_harder": 3, "positive_feedback_count": 1, "shorter_time": 1}
+    assert read_summary() == {"preferences": merged}
+
+
+@pytest.mark.skipif(os.name == "nt", reason="POSIX file modes")
+def test_merge_keeps_summary_file_mode():
+    feedback_store.merge_feedback_deltas({"make_harder": 1})
+    assert os.stat(feedback_store.FEEDBACK_FILE).st_mode & 0o777 == 0o666 & ~feedback_store.UMASK
+
+    os.chmod(feedback_store.FEEDBACK_FILE, 0o644)
+    feedback_store.merge_feedback_deltas({"make_harder": 1})
+
+    assert os.stat(feedback_store.FEEDBACK_FILE).st_mode & 0o777 == 0o644
+
+
+@pytest.mark.skipif(not feedback_store.OS_LOCK, reason="no flock/msvcrt on this platform")
+def test_os_lock_excludes_second_holder(monkeypatch):
+    monkeypatch.setattr(feedback_store, "LOCK_TIMEOUT", 0.1)
+    handle = feedback_store.acquire_summary_lock()
+    try:
+        assert feedback_store.merge_feedback_deltas({"make_harder": 1}) is None
+    finally:
+        feedback_store.release_summary_lock(handle)
+
+    assert feedback_store.merge_feedback_deltas({"make_harder": 1}) == {"make_harder": 1}
+
+
+@pytest.mark.skipif(os.name == "nt", reason="no PID probe on Windows")
+def test_steals_lock_of_dead_owner(in_tmp_dir, lockfile_fallback):
+    write_lock(f"{dead_pid()} abc")
+
+    feedback_store.merge_feedback_deltas({"make_harder": 1})
+
+    assert read_summary() == {"preferences": {"make_harder": 1}}
+    assert sorted(os.listdir(in_tmp_dir)) == [feedback_store.FEEDBACK_FILE]
+
+
+def test_steals_lock_older_than_stale_limit(in_tmp_dir, lockfile_fallback):
+    write_lock(f"{os.getpid()} abc", age=feedback_store.LOCK_STALE_AFTER + 5)
+
+    feedback_store.merge_feedback_deltas({"make_easier": 2})
+
+    assert read_summary() == {"preferences": {"make_easier": 2}}
+    assert sorted(os.listdir(in_tmp_dir)) == [feedback_store.FEEDBACK_FILE]
+
+
+def test_waits_for_live_lock(monkeypatch, lockfile_fallback):
+    monkeypatch.setattr(feedback_store, "LOCK_TIMEOUT", 0.1)
+    write_lock(f"{os.getpid()} live")
+
+    with pytest.raises(TimeoutError):
+        feedback_store.acquire_summary_lock()
+    assert lock_token() == f"{os.getpid()} live"
+
+
+def test_steal_never_puts_back_a_fresh_lock(in_tmp_dir, lockfile_fallback):
+    # Another waiter already replaced the stale lock with a fresh one
+    write_lock(f"{os.getpid()} fresh")
+
+    feedback_store.steal_stale_lock(f"{os.getpid()} stale")
+
+    # Restoring it could orphan it if its holder released meanwhile
+    assert os.listdir(in_tmp_dir) == []
+    assert not feedback_store.lock_still_held(f"{os.getpid()} fresh")
+
+
+def test_merge_fails_when_lock_is_stolen_midway(monkeypatch, lockfile_fallback):
+    feedback_store.merge_feedback_deltas({"make_harder": 1})
+    load = feedback_store.load_feedback_summary
+
+    def load_while_others_take_the_lock():
+        # Waiter B misjudges our lock as stale and moves it; waiter C then takes it
+        feedback_store.steal_stale_lock("some stale token")
+        write_lock(f"{os.getpid()} C")
+        return load()
+
+    monkeypatch.setattr(feedback_store, "load_feedback_summary", load_while_others_take_the_lock)
+
+    assert feedback_store.merge_feedback_deltas({"make_harder": 5}) is None
+    assert read_summary() == {"preferences": {"make_harder": 1}}
+    assert lock_token() == f"{os.getpid()} C"
+
+
+def test_release_keeps_lock_taken_by_someone_else(lockfile_fallback):
+    token = feedback_store.acquire_summary_lock()
+    write_lock(f"{os.getpid()} other")
+
+    feedback_store.release_summary_lock(token)
+
+    assert lock_token() == f"{os.getpid()} other"
+
+
+WRITER = """
+import sys
+import feedback_store
+
+feedback_store.OS_LOCK = feedback_store.OS_LOCK and sys.argv[2] == "os"
+for _ in range(100):
+    assert feedback_store.merge_feedback_deltas({sys.argv[1]: 1, "total": 1}) is not None
+"""
+
+
+@pytest.mark.parametrize("lock_kind", ["os", "lockfile"])
+def test_two_writers_never_tear_or_lose_counts(in_tmp_dir, lock_kind):
+    env = {**os.environ, "PYTHONPATH": BACKEND_DIR}
+    writers = [
+        subprocess.Popen([sys.executable, "-c", WRITER, name, lock_kind], cwd=in_tmp_dir, env=env)
+        for name in ("a", "b")
+    ]
+
+    # Every read while both are writing must see a complete summary
+    while any(w.poll() is None for w in writers):
+        if os.path.exists(feedback_store.FEEDBACK_FILE):
+            assert "total" in read_summary()["preferences"]
+
+    assert [w.returncode for w in writers] == [0, 0]
+    assert read_summary() == {"preferences": {"a": 100, "b": 100, "total": 200}}
+    leftovers = set(os.listdir(in_tmp_dir)) - {feedback_store.FEEDBACK_FILE, feedback_store.FEEDBACK_LOCK_FILE}
+    assert not leftovers
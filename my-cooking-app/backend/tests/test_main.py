@@ -0,0 +1,171 @@
+from fastapi.testclient import TestClient
+
+import orjson
+import pytest
+
+import asyncio
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+import feedback_store
+import main
+import recipe_core
+import simple_main
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(tmp_path, monkeypatch):
+    # Store paths are relative, so each test gets its own files
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, "PENDING", Counter())
+    monkeypatch.setattr(main, "disk_prefs", Counter())
+    monkeypatch.setattr(main, "disk_loaded_at", 0)
+    monkeypatch.setattr(main, "ADAPTIVE_PROMPT", None)
+    monkeypatch.setattr(main, "flush_task", None)
+    monkeypatch.setattr(main, "summary_lock", asyncio.Lock())
+    monkeypatch.setattr(main, "write_lock", asyncio.Lock())
+    recipe_core.REPLY_CACHE.clear()
+    return tmp_path
+
+
+def capture_prompts(monkeypatch):
+    prompts = []
+
+    async def fake_reply(full_prompt):
+        prompts.append(full_prompt)
+        return "ok"
+
+    monkeypatch.setattr(main, "generate_reply", fake_reply)
+    return prompts
+
+
+def stub_stream(monkeypatch, parts, fail=False):
+    async def generate_content_stream(model, contents):
+        async def stream():
+            for text in parts:
+                yield SimpleNamespace(text=text)
+            if fail:
+                raise RuntimeError("connection reset")
+        return stream()
+
+    models = SimpleNamespace(generate_content_stream=generate_content_stream)
+    monkeypatch.setattr(main, "google_client", SimpleNamespace(aio=SimpleNamespace(models=models)))
+
+
+def read_events(res):
+    # [(event, data), ...] from a text/event-stream body
+    events = []
+    for block in res.text.split("\n\n"):
+        if block:
+            event, data = block.split("\n")
+            events.append((event.removeprefix("event: "), orjson.loads(data.removeprefix("data: "))))
+    return events
+
+
+def test_refresh_racing_a_flush_keeps_the_flushed_counts(monkeypatch):
+    release = threading.Event()
+    reading = threading.Event()
+
+    def slow_load():
+        # Snapshot of the file from before the flush below
+        reading.set()
+        release.wait(5)
+        return {"preferences": {}}
+
+    async def scenario():
+        monkeypatch.setattr(main, "load_feedback_summary", slow_load)
+        refresh = asyncio.create_task(main.refresh_preferences())
+        await asyncio.to_thread(reading.wait, 5)
+        main.PENDING["make_easier"] += 1
+        await main.flush_pending_feedback()
+        release.set()
+        await refresh
+
+    asyncio.run(scenario())
+    assert main.disk_prefs == Counter({"make_easier": 1})
+    assert not main.PENDING
+
+
+def test_chat_sends_empty_json_object_as_plain_text(monkeypatch):
+    async def fake_reply(full_prompt):
+        return "{}"
+
+    monkeypatch.setattr(main, "generate_reply", fake_reply)
+    with TestClient(main.app) as client:
+        res = client.post("/api/chat", json={"message": "a recipe please"})
+    assert res.json() == {"reply": "{}", "is_json": False}
+
+
+def test_stream_relays_chunks_then_done(monkeypatch):
+    stub_stream(monkeypatch, ['{"recipes": ', "", '[]}'])
+    with TestClient(main.app) as client:
+        res = client.post("/api/chat/stream", json={"message": "a recipe please"})
+    assert res.headers["content-type"].startswith("text/event-stream")
+    assert read_events(res) == [
+        ("chunk", '{"recipes": '),
+        ("chunk", "[]}"),
+        ("done", {"reply": {"recipes": []}, "is_json": True}),
+    ]
+
+
+def test_stream_done_has_no_reply_for_chat_turns(monkeypatch):
+    stub_stream(monkeypatch, ["Hi\n", "there"])
+    with TestClient(main.app) as client:
+        res = client.post("/api/chat/stream", json={"message": "hello"})
+    assert read_events(res) == [
+        ("chunk", "Hi\n"),
+        ("chunk", "there"),
+        ("done", {"reply": None, "is_json": False}),
+    ]
+
+
+def test_stream_failure_sends_error_without_done(monkeypatch):
+    stub_stream(monkeypatch, ["Hal"], fail=True)
+    with TestClient(main.app) as client:
+        res = client.post("/api/chat/stream", json={"message": "hello"})
+    assert read_events(res) == [
+        ("chunk", "Hal"),
+        ("error", {"message": "Failed to get a complete response from Gemini."}),
+    ]
+
+
+@pytest.mark.parametrize(
+    "app, path",
+    [(main.app, "/api/chat"), (main.app, "/api/chat/stream"), (simple_main.app, "/api/chat")],
+)
+def test_oversized_message_gets_413_in_reply_shape(app, path):
+    with TestClient(app) as client:
+        res = client.post(path, json={"message": "x" * (recipe_core.MAX_MESSAGE_CHARS + 1)})
+    assert res.status_code == 413
+    assert res.json() == {
+        "reply": f"Error: Please keep messages under {recipe_core.MAX_MESSAGE_CHARS} characters.",
+        "is_json": False,
+    }
+
+
+def test_feedback_reaches_prompt_before_and_after_the_flush(monkeypatch):
+    monkeypatch.setattr(main, "FLUSH_DELAY", 0.05)
+    prompts = capture_prompts(monkeypatch)
+    with TestClient(main.app) as client:
+        client.post("/api/feedback", json={"type": "downvote", "message": "Way too hard"})
+        client.post("/api/chat", json={"message": "hello"})
+        assert main.PENDING == Counter({"negative_feedback_count": 1, "make_easier": 1})
+        assert "Simplify recipes" in prompts[-1]
+
+        time.sleep(0.3)
+        assert not main.PENDING
+        assert feedback_store.load_feedback_summary() == {
+            "preferences": {"negative_feedback_count": 1, "make_easier": 1}
+        }
+        client.post("/api/chat", json={"message": "hello again"})
+        assert "Simplify recipes" in prompts[-1]
+
+
+def test_failed_merge_keeps_deltas_pending(monkeypatch):
+    monkeypatch.setattr(main, "merge_feedback_deltas", lambda deltas: None)
+    main.PENDING["make_harder"] += 2
+    asyncio.run(main.flush_pending_feedback())
+    assert main.PENDING == Counter({"make_harder": 2})
+    assert main.disk_prefs == Counter()
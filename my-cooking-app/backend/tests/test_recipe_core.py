@@ -0,0 +1,60 @@
+import pytest
+
+from recipe_core import (
+    MAX_HISTORY_CHARS,
+    MAX_HISTORY_TURNS,
+    MAX_MESSAGE_CHARS,
+    ChatMessage,
+    build_prompt,
+    parse_recipe_reply,
+)
+
+
+@pytest.mark.parametrize("reply", ["", "   \n\t", "```", "```json\n```"])
+def test_parse_empty_reply_returns_none(reply):
+    assert parse_recipe_reply(reply) is None
+
+
+def test_parse_fenced_json_object():
+    reply = '```json\n{"recipes": [{"name": "Soup"}]}\n```'
+    assert parse_recipe_reply(reply) == {"recipes": [{"name": "Soup"}]}
+
+
+def test_parse_bare_fenced_json_list():
+    assert parse_recipe_reply('```\n[1, 2]\n```') == [1, 2]
+
+
+def test_parse_json_wrapped_in_prose_returns_none():
+    assert parse_recipe_reply('Here you go: {"recipes": []} Enjoy!') is None
+
+
+def test_parse_invalid_json_returns_none():
+    assert parse_recipe_reply("{not json}") is None
+
+
+def test_parse_empty_object_is_falsy():
+    # The endpoints send the plain reply text when the parse is falsy
+    assert parse_recipe_reply("{}") == {}
+
+
+def conversation_of(full_prompt):
+    # The turns between the adaptive notes and the instruction
+    return full_prompt.split("NOTES\n\n\n", 1)[1].rsplit("\n", 2)[0]
+
+
+def test_prompt_keeps_only_recent_turns():
+    history = [ChatMessage(role="user", text=f"turn {i}") for i in range(MAX_HISTORY_TURNS + 5)]
+    full_prompt, _ = build_prompt("hello", history, "NOTES")
+    lines = conversation_of(full_prompt).split("\n")
+    assert lines[0] == "User: turn 5"
+    assert lines[-1] == "User: hello"
+    assert len(lines) == MAX_HISTORY_TURNS + 1
+
+
+def test_prompt_caps_history_chars_but_not_the_message():
+    history = [ChatMessage(role="model", text="y" * MAX_HISTORY_CHARS) for _ in range(3)]
+    message = "z" * MAX_MESSAGE_CHARS
+    full_prompt, _ = build_prompt(message, history, "NOTES")
+    conversation = conversation_of(full_prompt)
+    assert conversation.endswith("\nUser: " + message)
+    assert len(conversation) == MAX_HISTORY_CHARS + len("\nUser: ") + len(message)